@@ -1,163 +1,229 @@
+import binascii
+import contextlib
+import mmap
+import os
 import re
-import json
+import stat
 import sys
 
+try:
+    from orjson import loads as _jloads
+except ImportError:
+    _jloads = None
+
 
 HEADER = """pico-8 cartridge // http://www.pico-8.com
 version 0
 __lua__
 """
 
-class BitReader:
-    def __init__(self, data):
-        self.data = data
-        self.byte_index = 0
-        self.bit_index = 0  # 0 = LSB, 7 = MSB
-    
-    def read_bit(self):
-        if self.byte_index >= len(self.data):
-            raise ValueError("Input data exhausted")
-        
-        byte = self.data[self.byte_index]
-        bit = (byte >> self.bit_index) & 1
-        self.bit_index += 1
-        
-        if self.bit_index == 8:
-            self.bit_index = 0
-            self.byte_index += 1
-            
-        return bit
-    
-    def read_bits(self, n):
-        value = 0
-        for i in range(n):
-            bit = self.read_bit()
-            value |= (bit << i)  # LSB-first
-        return value
+_PAT_NAME = re.compile(rb"var\s+_cartname\s*=\s*\[\s*`([^`]*)`\s*\];")
+# Only the opening bracket; the array holds plain numbers, so the first
+# ']' after it closes it
+_PAT_DATA = re.compile(rb"var\s+_cartdat\s*=\s*\[")
+
+# Pico-8 button glyphs, by their P8SCII byte
+_GLYPHS = {
+    0x94: '⬆️',
+    0x83: '⬇️',
+    0x8b: '⬅️',
+    0x91: '➡️',
+    0x8e: '🅾️',
+    0x97: '❎',
+}
+# Bytes that are not valid UTF-8 decode (surrogateescape) to U+DC80-U+DCFF;
+# glyph bytes become their emoji and the rest a \xNN escape
+_LUA_TRANSLATE = {0xDC00 + b: _GLYPHS.get(b, f'\\x{b:02x}') for b in range(0x80, 0x100)}
+
+# Low-bit masks for field widths read by decompress
+_MASK = tuple((1 << i) - 1 for i in range(33))
+# Next two bits of an LZ77 token -> (offset_bits, bits used by the code):
+# '0' -> 15, '10' -> 10, '11' -> 5 (first bit in the low position)
+_OFFSET_CODES = ((15, 1), (10, 2), (15, 1), (5, 2))
 
 def decompress(compressed_data, decompressed_len):
-    mtf = list(range(256))  # Initialize MTF: [0, 1, 2, ..., 255]
-    output = []
-    reader = BitReader(compressed_data)
-    
-    while len(output) < decompressed_len:
-        header_bit = reader.read_bit()
-        
+    data = compressed_data
+    byte_index = 0
+    # Bit window: the next `avail` unread bits, LSB first. Bits past the end
+    # of the data read as zero; avail going negative means exhausted input,
+    # checked once a token's fields are read and before anything is output.
+    buf = 0
+    avail = 0
+    mtf = bytearray(range(256))  # Initialize MTF: [0, 1, 2, ..., 255]
+    out = bytearray(decompressed_len)
+    op = 0
+
+    while op < decompressed_len:
+        # 32 bits cover every fixed-size field of one token
+        if avail < 32:
+            chunk = data[byte_index:byte_index + 4]
+            buf |= int.from_bytes(chunk, 'little') << avail
+            avail += 8 * len(chunk)
+            byte_index += 4
+
+        header_bit = buf & 1
+        buf >>= 1
+
         if header_bit == 1:  # Case: byte from MTF
-            # Read unary
-            unary = 0
-            while reader.read_bit() == 1:
-                unary += 1
-            
+            # Read unary: count of trailing 1 bits, found by isolating
+            # the lowest 0 bit
+            unary = ((buf + 1) & ~buf).bit_length() - 1
+            if unary > 4:  # index would be past 255
+                raise ValueError(f"Invalid MTF index prefix: {unary} bits")
+            buf >>= unary + 1
+
             # Calculate index
-            unary_mask = (1 << unary) - 1
+            unary_mask = _MASK[unary]
             num_bits = 4 + unary
-            bits_val = reader.read_bits(num_bits)
+            bits_val = buf & _MASK[num_bits]
+            buf >>= num_bits
+            avail -= 2 + unary + num_bits
+            if avail < 0:
+                raise ValueError("Input data exhausted")
             index = bits_val + (unary_mask << 4)
-            
+            if index > 255:
+                raise ValueError(f"Invalid MTF index: {index}")
+
             # Get byte and update MTF
             byte_val = mtf[index]
-            del mtf[index]
-            mtf.insert(0, byte_val)
-            output.append(byte_val)
-            
+            mtf[1:index + 1] = mtf[:index]  # shift prefix in place
+            mtf[0] = byte_val
+            out[op] = byte_val
+            op += 1
+
         else:  # Case: LZ77 sequence
             # Read offset size
-            if reader.read_bit() == 1:
-                if reader.read_bit() == 1:
-                    offset_bits = 5
-                else:
-                    offset_bits = 10
-            else:
-                offset_bits = 15
-            
+            offset_bits, code_bits = _OFFSET_CODES[buf & 3]
+            buf >>= code_bits
+            avail -= 1 + code_bits
+
             # Read offset
-            offset = reader.read_bits(offset_bits) + 1
-            
+            offset = (buf & _MASK[offset_bits]) + 1
+            buf >>= offset_bits
+            avail -= offset_bits
+            if avail < 0:
+                raise ValueError("Input data exhausted")
+
             # Special case: uncompressed block
             if offset_bits == 10 and offset == 1:
-                while True:
-                    byte_val = reader.read_bits(8)
-                    if byte_val == 0:  # End of block
-                        break
-                    output.append(byte_val)
-                    if len(output) >= decompressed_len:
+                # Raw bytes up to a NUL, decoded a chunk at a time
+                while op < decompressed_len:
+                    count = min(decompressed_len - op, 32)
+                    chunk = data[byte_index:byte_index + count]
+                    buf |= int.from_bytes(chunk, 'little') << avail
+                    avail += 8 * len(chunk)
+                    byte_index += len(chunk)
+                    count = min(count, avail >> 3)
+                    if count <= 0:
+                        raise ValueError("Input data exhausted")
+                    raw = (buf & ((1 << (8 * count)) - 1)).to_bytes(count, 'little')
+                    end = raw.find(0)
+                    if end >= 0:  # End of block
+                        out[op:op + end] = raw[:end]
+                        op += end
+                        buf >>= 8 * (end + 1)
+                        avail -= 8 * (end + 1)
                         break
+                    out[op:op + count] = raw
+                    op += count
+                    buf >>= 8 * count
+                    avail -= 8 * count
             else:
                 # Read length
                 length = 3
                 while True:
-                    part = reader.read_bits(3)
+                    if avail < 3:
+                        chunk = data[byte_index:byte_index + 4]
+                        buf |= int.from_bytes(chunk, 'little') << avail
+                        avail += 8 * len(chunk)
+                        byte_index += 4
+                    part = buf & 7
+                    buf >>= 3
+                    avail -= 3
                     length += part
                     if part != 7:
                         break
-                
+                if avail < 0:
+                    raise ValueError("Input data exhausted")
+
                 # Copy sequence from output
-                start = len(output) - offset
-                if start < 0:
-                    raise ValueError(f"Invalid offset: {offset} (output len={len(output)})")
-                
-                for i in range(length):
-                    if len(output) >= decompressed_len:
-                        break
-                    output.append(output[start + i % offset])
-    
-    return bytes(output)
-
-def format_gfx(gfx_bytes):
-    gfx_lines = []
-    for y in range(128):  # 128 rows
-        row = []
-        for x in range(64):  # 64 bytes * 2 pixels = 128 pixels
-            byte = gfx_bytes[y * 64 + x]
-            lo = byte & 0x0F
-            hi = (byte >> 4) & 0x0F
-            row.append(f"{lo:x}{hi:x}")
-        gfx_lines.append(''.join(row))
-    return '\n'.join(gfx_lines)
-
-def format_map(map_bytes):
-    map_lines = []
-    for i in range(0, len(map_bytes), 128):  # 128 tiles por fila
-        row_bytes = map_bytes[i:i+128]
-        map_lines.append(''.join(f"{b:02x}" for b in row_bytes))
-    return '\n'.join(map_lines)
+                if offset > op:
+                    raise ValueError(f"Invalid offset: {offset} (output len={op})")
+
+                length = min(length, decompressed_len - op)
+                start = op - offset
+                if offset >= length:
+                    out[op:op + length] = out[start:start + length]
+                else:
+                    # Overlapping copy: the last `offset` bytes repeat
+                    out[op:op + length] = (out[start:op] * (length // offset + 1))[:length]
+                op += length
+
+    return bytes(out)
+
+def _swap_nibbles(data):
+    # SWAR: swap the nibbles of every byte at once on one big int
+    lo = int.from_bytes(b'\x0f' * len(data), 'big')
+    x = int.from_bytes(data, 'big')
+    return (((x & lo) << 4) | ((x >> 4) & lo)).to_bytes(len(data), 'big')
+
+def _hex_rows(hexed, row_len):
+    return b'\n'.join([hexed[i:i + row_len] for i in range(0, len(hexed), row_len)])
+
+def format_gfx_map_gff(gfx_bytes, map_bytes, gff_bytes):
+    """Formatea gfx, map y gff con un solo hexlify; devuelve las tres secciones."""
+    gfx_bytes = _swap_nibbles(gfx_bytes[:128 * 64])  # pixels are low nibble first
+    gff_bytes = gff_bytes[:256]
+    hexed = memoryview(binascii.hexlify(gfx_bytes + map_bytes + gff_bytes))
+    map_start = 2 * len(gfx_bytes)
+    gff_start = map_start + 2 * len(map_bytes)
+    return (
+        _hex_rows(hexed[:map_start], 128),            # 128 pixels por fila
+        _hex_rows(hexed[map_start:gff_start], 256),   # 128 tiles por fila
+        _hex_rows(hexed[gff_start:], 256),            # 128 flags por fila
+    )
+
+# Note lsb -> pitch digits
+_SFX_PITCH = [b"%02x" % (b & 0x3F) for b in range(256)]
+# (msb << 2) | (lsb >> 6) -> waveform, volume and effect digits
+_SFX_WVE = [
+    b"%x%x%x" % (((msb & 0x80) >> 4) | ((msb & 0x01) << 2) | lsb_hi, (msb >> 1) & 0x07, (msb >> 4) & 0x07)
+    for msb in range(256) for lsb_hi in range(4)
+]
 
 def format_sfx(sfx_bytes):
     lines = []
     for i in range(64):  # 64 sfx entries
         offset = i * 68
         entry = sfx_bytes[offset:offset + 68]
-        notes = entry[:64]
-        editor_mode = entry[64]
-        note_duration = entry[65]
-        loop_start = entry[66]
-        loop_end = entry[67]
 
-        # Convert header
-        line = f"{editor_mode:02x}{note_duration:02x}{loop_start:02x}{loop_end:02x}"
+        # Convert header: editor mode, note duration, loop start, loop end
+        line = binascii.hexlify(entry[64:68])
 
         # Convert notes (32 notes = 64 bytes, 5 nibbles per note = 160 nibbles = 40 bytes = 80 hex chars)
-        for j in range(0, 64, 2):
-            lsb = notes[j]
-            msb = notes[j + 1]
-            pitch = lsb & 0x3F
-            waveform = ((msb & 0x80) >> 4) | ((msb & 0x01) << 2) | ((lsb & 0xC0) >> 6)
-            volume = (msb >> 1) & 0x07
-            effect = (msb >> 4) & 0x07
-            line += f"{pitch:02x}{waveform:x}{volume:x}{effect:x}"
+        lsbs = entry[0:64:2]
+        msbs = entry[1:64:2]
+        line += b''.join([
+            _SFX_PITCH[lsb] + _SFX_WVE[(msb << 2) | (lsb >> 6)]
+            for lsb, msb in zip(lsbs, msbs)
+        ])
 
         lines.append(line)
-    return '\n'.join(lines)
-
-def format_gff(gff_bytes):
-    """Formatea 256 bytes de datos gff en 2 líneas hexadecimales (128 bytes por línea)."""
-    lines = []
-    for i in range(0, 256, 128):  # Procesar en chunks de 128 bytes
-        chunk = gff_bytes[i:i+128]
-        hex_line = ''.join(f"{b:02x}" for b in chunk)
-        lines.append(hex_line)
-    return '\n'.join(lines)
+    return b'\n'.join(lines)
+
+def parse_cartdat(array_bytes):
+    # array_bytes is the whole `[...]` literal of plain integers
+    if _jloads is not None:
+        return bytes(_jloads(array_bytes))
+    return bytes(map(int, array_bytes[1:-1].split(b',')))
+
+def _map_file(file):
+    # Only non-empty regular files can be mapped; pipes, FIFOs and empty
+    # files are read instead (bytes, so the same patterns apply)
+    st = os.fstat(file.fileno())
+    if not (stat.S_ISREG(st.st_mode) and st.st_size > 0):
+        return contextlib.nullcontext(file.read())
+    return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
 
 def main():
     if len(sys.argv) < 2:
@@ -166,69 +232,68 @@ def main():
     
     filename = sys.argv[1]
     
-    # 1. Read the file
-    with open(filename, 'r', encoding='utf-8') as file:
-        content = file.read()
-
-    pattern_name = r"var\s+_cartname\s*=\s*\[\s*`([^`]*)`\s*\];"
-    pattern_data = r"var\s+_cartdat\s*=\s*(\[[\s\S]*?\]);"
-
-    match = re.search(pattern_name, content)
-
-    cart_name = "game.p8"
-    if match:
-        cart_name = match.group(1)
+    # 1. Map the file; only the matched parts are copied out of it
+    with open(filename, 'rb') as file, _map_file(file) as content:
+        match = _PAT_NAME.search(content)
 
-    match = re.search(pattern_data, content)
+        cart_name = "game.p8"
+        if match:
+            cart_name = match.group(1).decode('utf-8')
 
-    if match:
-        array_str = match.group(1)
+        match = _PAT_DATA.search(content)
+        end = content.find(b']', match.end()) if match else -1
+        array_bytes = content[match.end() - 1:end + 1] if end != -1 else None
 
+    if array_bytes is not None:
         try:
-            cartdat_list = json.loads(array_str)
+            cartdat_bytes = parse_cartdat(array_bytes)
+        except (ValueError, TypeError):
+            print("Error decoding _cartdat.")
+            return
 
+        gfx_data   = cartdat_bytes[0x0000:0x2000]
+        map_lower  = cartdat_bytes[0x1000:0x2000]
+        map_upper  = cartdat_bytes[0x2000:0x3000]
+        map_data   = map_upper + map_lower
+        gff_data   = cartdat_bytes[0x3000:0x3100]
+        sfx_data   = cartdat_bytes[0x3200:0x4300]
 
-            cartdat_bytes = bytes(cartdat_list)
+        signature = cartdat_bytes[0x4300:0x4304]
+        decompressed_len = int.from_bytes(cartdat_bytes[0x4304:0x4306], byteorder='big')
+        compressed_len_plus_8 = int.from_bytes(cartdat_bytes[0x4306:0x4308], byteorder='big')
+        compressed_data = cartdat_bytes[0x4308:0x4308 + (compressed_len_plus_8 - 8)]
 
-            gfx_data   = cartdat_bytes[0x0000:0x2000]
-            map_lower  = cartdat_bytes[0x1000:0x2000]
-            map_upper  = cartdat_bytes[0x2000:0x3000]
-            map_data   = map_upper + map_lower
-            gff_data   = cartdat_bytes[0x3000:0x3100]
-            sfx_data   = cartdat_bytes[0x3200:0x4300]
+        decompressed_data = decompress(compressed_data, decompressed_len)
 
-            signature = cartdat_bytes[0x4300:0x4304]
-            decompressed_len = int.from_bytes(cartdat_bytes[0x4304:0x4306], byteorder='big')
-            compressed_len_plus_8 = int.from_bytes(cartdat_bytes[0x4306:0x4308], byteorder='big')
-            compressed_data = cartdat_bytes[0x4308:0x4308 + (compressed_len_plus_8 - 8)]
+        lua = decompressed_data.decode('utf-8', errors='surrogateescape').translate(_LUA_TRANSLATE)
 
-            decompressed_data = decompress(compressed_data, decompressed_len)
+        # Build the whole cartridge and write it in one go
+        cart = bytearray(HEADER.encode('utf-8'))
+        cart += lua.encode('utf-8')
 
-            with open(cart_name, 'w', encoding='utf-8') as f:
-                f.write(HEADER)
-                f.write(decompressed_data.decode('utf-8', errors='backslashreplace').replace(r'\x94', '⬆️').replace(r'\x83', '⬇️').replace(r'\x8b', '⬅️').replace(r'\x91', '➡️').replace(r'\x8e', '🅾️').replace(r'\x97', '❎'))
+        gfx_text, map_text, gff_text = format_gfx_map_gff(gfx_data, map_data, gff_data)
 
+        cart += b"\n__gfx__\n"
+        cart += gfx_text
 
-                f.write("\n__gfx__\n")
-                f.write(format_gfx(gfx_data))
+        cart += b"\n__map__\n"
+        cart += map_text
 
-                f.write("\n__map__\n")
-                f.write(format_map(map_data))
+        cart += b"\n__gff__\n"  # Nueva sección
+        cart += gff_text
 
-                f.write("\n__gff__\n")  # Nueva sección
-                f.write(format_gff(gff_data))
+        cart += b"\n__sfx__\n"
+        cart += format_sfx(sfx_data)
 
-                f.write("\n__sfx__\n")
-                f.write(format_sfx(sfx_data))
+        with open(cart_name, 'wb') as f:
+            f.write(cart)
 
 
-            print("Signature:", signature)
-            print("Decompressed size:", decompressed_len)
-            print("Compressed size (+8):", compressed_len_plus_8)
-            print("Compressed bytes:", compressed_data[:8], "...")
-            print(f"Saved in {cart_name}")
-        except json.JSONDecodeError:
-            print("Error decoding JSON.")
+        print("Signature:", signature)
+        print("Decompressed size:", decompressed_len)
+        print("Compressed size (+8):", compressed_len_plus_8)
+        print("Compressed bytes:", compressed_data[:8], "...")
+        print(f"Saved in {cart_name}")
     else:
         print("Variable _cartdat not found.")
 